@@ -1,10 +1,20 @@
 import os
+import re
+import orjson
+import hashlib
 import telebot
 import fitz   # PyMuPDF for PDF text extraction
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
+import heapq
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # ---------------------- ENV VARIABLES ----------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -12,16 +22,71 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", 10000))
 
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+GEMINI_VISION_URL = f"{GEMINI_BASE_URL}/gemini-pro-vision:generateContent?key={GEMINI_API_KEY}"
+GEMINI_TEXT_URL = f"{GEMINI_BASE_URL}/gemini-pro:generateContent?key={GEMINI_API_KEY}"
+if not GEMINI_API_KEY:
+    # without a key every Gemini request is rejected, so the helpers below skip the call
+    logging.warning("GEMINI_API_KEY is not set: AI answers and /solve explanations are disabled")
+
 bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
 app = Flask(__name__)
 
 # ---------------------- MEMORY ----------------------
 user_sessions = {}   # stores questions, answers, results, timer etc.
+SESSION_TTL = timedelta(hours=24)   # sessions unused for this long are dropped
+
+
+def evict_stale_sessions():
+    cutoff = datetime.now() - SESSION_TTL
+    for chat_id, session in list(user_sessions.items()):
+        if session["last_used"] < cutoff:
+            user_sessions.pop(chat_id, None)
+
+
+# ---------------------- BACKGROUND WORKERS ----------------------
+# Slow jobs run here so telebot's handler threads stay free.
+WORKERS = ThreadPoolExecutor(max_workers=4)        # PDF download + parsing
+# Quiz start-up holds a thread through Gemini and paced sends (minutes in groups),
+# so it gets its own pool and can never starve PDF uploads.
+QUIZ_WORKERS = ThreadPoolExecutor(max_workers=8)
+
+MAX_PDF_BYTES = 20 * 1024 * 1024   # Telegram bots cannot download files larger than 20 MB
+
+
+# ---------------------- GEMINI HTTP SESSION ----------------------
+# Shared keep-alive pool so Gemini calls reuse TCP/TLS connections.
+GEMINI_SESSION = requests.Session()
+GEMINI_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,      # generateContent is safe to repeat, so retry POST too
+        raise_on_status=False,     # hand the last response to raise_for_status
+    ),
+))
+GEMINI_TIMEOUT = 30   # seconds
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def gemini_post(url, data):
+    # orjson encodes straight to bytes; callers decode with orjson.loads(r.content)
+    r = GEMINI_SESSION.post(url, data=orjson.dumps(data), headers=JSON_HEADERS, timeout=GEMINI_TIMEOUT)
+    if not r.ok:
+        # log the status only: the URL carries the API key
+        logging.warning("Gemini request failed with HTTP %s", r.status_code)
+    r.raise_for_status()
+    return r
 
 
 # ---------------------- GEMINI OCR ----------------------
 def gemini_extract_text(image_bytes):
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent?key=" + GEMINI_API_KEY
+    if not GEMINI_API_KEY:
+        return ""
+
     data = {
         "contents": [
             {
@@ -32,16 +97,52 @@ def gemini_extract_text(image_bytes):
             }
         ]
     }
-    r = requests.post(url, json=data)
-    result = r.json()
     try:
-        return result["candidates"][0]["content"]["parts"][0]["text"]
-    except:
+        r = gemini_post(GEMINI_VISION_URL, data)
+        return orjson.loads(r.content)["candidates"][0]["content"]["parts"][0]["text"]
+    except (requests.RequestException, KeyError, IndexError, ValueError):
         return ""
 
 
+# ---------------------- GEMINI RESPONSE CACHE ----------------------
+# Question banks get reused across PDFs; identical MCQs skip the Gemini call.
+CACHE_MAX = 5000
+ANSWER_CACHE = {}    # mcq_key -> correct option letter
+EXPLAIN_CACHE = {}   # mcq_key -> /solve explanation
+CACHE_LOCK = threading.Lock()   # serializes evict+insert; readers use a single .get()
+
+
+def mcq_key(question, options):
+    raw = question + "\0" + "\0".join(f"{k}={v}" for k, v in sorted(options.items()))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cache_put(cache, key, value, max_size=CACHE_MAX):
+    with CACHE_LOCK:
+        if len(cache) >= max_size:
+            cache.pop(next(iter(cache)), None)   # drop the oldest entry
+        cache[key] = value
+
+
 # ---------------------- GEMINI ANSWER FINDER ----------------------
+# Reply must open with the letter ("C", "(C)", "**C**", "C) ..."); "Answer: C" does not count.
+ANSWER_LETTER_RE = re.compile(r"\s*\**\(?([A-D])\b")
+
+
+def parse_answer_letter(text):
+    m = ANSWER_LETTER_RE.match(text)
+    return m.group(1) if m else None
+
+
 def gemini_answer(question, options):
+    if not GEMINI_API_KEY:
+        return "A"
+
+    key = mcq_key(question, options)
+    cached = ANSWER_CACHE.get(key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
 MCQ QUESTION:
 {question}
@@ -54,94 +155,201 @@ D) {options.get('D')}
 
 Return only correct option letter (A/B/C/D).
 """
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key=" + GEMINI_API_KEY
     data = {"contents": [{"parts": [{"text": prompt}]}]}
-    r = requests.post(url, json=data)
     try:
-        text = r.json()["candidates"][0]["content"]["parts"][0]["text"]
-        for ch in ["A", "B", "C", "D"]:
-            if ch in text:
-                return ch
-    except:
-        pass
-    return "A"
+        r = gemini_post(GEMINI_TEXT_URL, data)
+        text = orjson.loads(r.content)["candidates"][0]["content"]["parts"][0]["text"]
+    except (requests.RequestException, KeyError, IndexError, ValueError):
+        return "A"
+
+    letter = parse_answer_letter(text)
+    if letter is None:
+        return "A"   # unparseable reply: default, never cached
+    cache_put(ANSWER_CACHE, key, letter)
+    return letter
+
+
+# ---------------------- GEMINI BATCH ANSWER FINDER ----------------------
+GEMINI_BATCH_SIZE = 25   # questions per prompt, keeps each request well under token limits
+
+
+def gemini_answer_batch(mcqs):
+    if not GEMINI_API_KEY:
+        return ["A"] * len(mcqs)
+
+    keys = [mcq_key(q["question"], q["options"]) for q in mcqs]
+    answers = {}
+    for k in keys:
+        cached = ANSWER_CACHE.get(k)
+        if cached is not None:
+            answers[k] = cached
+
+    # repeated questions in one PDF are asked once, then fanned back out by key
+    misses = {}
+    for k, q in zip(keys, mcqs):
+        if k not in answers:
+            misses.setdefault(k, q)
+
+    unique = list(misses.values())
+    chunks = [unique[i:i + GEMINI_BATCH_SIZE] for i in range(0, len(unique), GEMINI_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        results = ex.map(gemini_answer_chunk, chunks)
+        answers.update(zip(misses, [ans for chunk in results for ans in chunk]))
+
+    return [answers[k] for k in keys]
+
+
+def gemini_answer_chunk(mcqs):
+    prompt = """
+Answer each MCQ below.
+Return only a JSON object mapping question number to correct option letter (A/B/C/D), e.g. {"1": "A", "2": "C"}.
+"""
+    for n, q in enumerate(mcqs, 1):
+        options = q["options"]
+        prompt += f"""
+Q{n}: {q['question']}
+A) {options.get('A')}
+B) {options.get('B')}
+C) {options.get('C')}
+D) {options.get('D')}
+"""
+    data = {"contents": [{"parts": [{"text": prompt}]}]}
+    try:
+        r = gemini_post(GEMINI_TEXT_URL, data)
+    except requests.RequestException:
+        # the endpoint already failed after retries; per-question calls would only pile on
+        return ["A"] * len(mcqs)
+
+    try:
+        text = orjson.loads(r.content)["candidates"][0]["content"]["parts"][0]["text"]
+        letters = orjson.loads(text[text.find("{"):text.rfind("}") + 1])
+    except (KeyError, IndexError, ValueError):
+        letters = {}
+    if not isinstance(letters, dict):
+        letters = {}
+
+    answers = []
+    for n, q in enumerate(mcqs, 1):
+        letter = parse_answer_letter(str(letters.get(str(n), "")))
+        if letter is not None:
+            cache_put(ANSWER_CACHE, mcq_key(q["question"], q["options"]), letter)
+        else:
+            # malformed or missing in the batched reply: ask for this one on its own;
+            # gemini_answer caches only strictly parsed letters
+            letter = gemini_answer(q["question"], q["options"])
+        answers.append(letter)
+    return answers
 
 
 # ---------------------- PARSE MCQ OPTION-B FORMAT ----------------------
-def parse_mcqs(text):
-    lines = text.split("\n")
+# One line per match: group 1 is a question line ("12) ..."), groups 2/3 an option ("(A) ..." / "A) ...").
+MCQ_LINE_RE = re.compile(r"^[^\S\n]*(?:(\d[^\n]*\)[^\n]*)|\(?([A-D])\)([^\n]*))$", re.M)
+
+
+def parse_mcqs(pages):
+    # pages: iterable of page texts; question state carries across page breaks
     questions = []
     q = ""
     opts = {}
 
-    for line in lines:
-        line = line.strip()
+    for page_text in pages:
+        for m in MCQ_LINE_RE.finditer(page_text):
+            head, letter, body = m.groups()
 
-        if line == "":
-            continue
+            if head is not None:
+                if q != "":
+                    questions.append({"question": q, "options": opts})
+                q = head.strip()
+                opts = {}
 
-        if line[0].isdigit() and ")" in line:
-            if q != "":
-                questions.append({"question": q, "options": opts})
-            q = line
-            opts = {}
+            else:
+                opts[letter] = body.strip()
 
-        elif line.startswith("(A)") or line.startswith("A)"):
-            opts["A"] = line.split(")", 1)[1].strip()
+    if q != "":
+        questions.append({"question": q, "options": opts})
 
-        elif line.startswith("(B)") or line.startswith("B)"):
-            opts["B"] = line.split(")", 1)[1].strip()
+    return questions
 
-        elif line.startswith("(C)") or line.startswith("C)"):
-            opts["C"] = line.split(")", 1)[1].strip()
 
-        elif line.startswith("(D)") or line.startswith("D)"):
-            opts["D"] = line.split(")", 1)[1].strip()
+# ---------------------- PDF PAGE STREAM ----------------------
+# Normalized text for the MCQ parser: ligatures expanded ("ﬁ" -> "fi"), odd spaces made plain,
+# unknown glyphs as U+FFFD instead of CID codes.
+TEXT_FLAGS = fitz.TEXT_MEDIABOX_CLIP
 
-    if q != "":
-        questions.append({"question": q, "options": opts})
 
-    return questions
+def iter_pdf_pages(pdf_bytes):
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        for page in doc:
+            yield page.get_text("text", flags=TEXT_FLAGS)
+    finally:
+        doc.close()
+
+
+# ---------------------- TIME KEYBOARD ----------------------
+# Identical for every chat, so it is built and serialized once at import.
+TIME_MARKUP = telebot.types.InlineKeyboardMarkup(keyboard=[
+    [telebot.types.InlineKeyboardButton(f"{t} min", callback_data=f"time_{t}")]
+    for t in ("5", "10", "30", "60", "90")
+]).to_json()
+
+
+# ---------------------- PARSED PDF CACHE ----------------------
+# Re-uploads of the same file skip extraction and parsing; answers then hit ANSWER_CACHE.
+PDF_CACHE_MAX = 100
+PDF_CACHE = {}   # sha256 of PDF bytes -> parsed mcqs
 
 
 # ---------------------- PDF HANDLER ----------------------
 @bot.message_handler(content_types=['document'])
 def pdf_handler(message):
-    chat_id = message.chat.id
-
-    file_id = message.document.file_id
-    file = bot.get_file(file_id)
-    pdf_bytes = bot.download_file(file.file_path)
+    doc = message.document
+    name = (doc.file_name or "").strip().lower()
+    if not (name.endswith(".pdf") or doc.mime_type == "application/pdf"):
+        bot.reply_to(message, "❌ Please send a PDF file.")
+        return
 
-    with open("temp.pdf", "wb") as f:
-        f.write(pdf_bytes)
+    if doc.file_size and doc.file_size > MAX_PDF_BYTES:
+        bot.reply_to(message, "❌ PDF is too large (max 20 MB).")
+        return
 
     bot.reply_to(message, "⏳ Extracting text from PDF... Wait 5–10 seconds")
+    WORKERS.submit(process_pdf, message)
 
-    extracted_text = ""
-    doc = fitz.open("temp.pdf")
-    for page in doc:
-        extracted_text += page.get_text()
 
-    mcqs = parse_mcqs(extracted_text)
+def process_pdf(message):
+    chat_id = message.chat.id
+
+    try:
+        file_id = message.document.file_id
+        file = bot.get_file(file_id)
+        pdf_bytes = bot.download_file(file.file_path)
+
+        key = hashlib.sha256(pdf_bytes).hexdigest()
+        mcqs = PDF_CACHE.get(key)
+        if mcqs is None:
+            mcqs = parse_mcqs(iter_pdf_pages(pdf_bytes))
+            cache_put(PDF_CACHE, key, mcqs, max_size=PDF_CACHE_MAX)
+    except Exception:
+        logging.exception("Failed to process PDF for chat %s", chat_id)
+        bot.send_message(chat_id, "❌ Could not read this PDF.")
+        return
 
     if len(mcqs) == 0:
         bot.send_message(chat_id, "❌ No MCQs found. Make sure PDF is Option-B format.")
         return
 
+    evict_stale_sessions()
     user_sessions[chat_id] = {
         "mcqs": mcqs,
         "answers": {},
         "correct_ans": {},
+        "last_used": datetime.now(),   # bumped on quiz start and every answer
         "start_time": None,
         "end_time": None
     }
 
-    markup = telebot.types.InlineKeyboardMarkup()
-    for t in ["5", "10", "30", "60", "90"]:
-        markup.add(telebot.types.InlineKeyboardButton(f"{t} min", callback_data=f"time_{t}"))
-
-    bot.send_message(chat_id, "⏳ Select Quiz Time:", reply_markup=markup)
+    bot.send_message(chat_id, "⏳ Select Quiz Time:", reply_markup=TIME_MARKUP)
 
 
 # ---------------------- TIME SELECT ----------------------
@@ -150,33 +358,86 @@ def time_set(call):
     chat_id = call.message.chat.id
     minutes = int(call.data.split("_")[1])
 
+    session = user_sessions.get(chat_id)
+    if not session:
+        bot.answer_callback_query(call.id, "❌ Session expired. Please upload the PDF again.")
+        return
+
     bot.edit_message_text(f"⏳ Quiz Time Set: {minutes} min\nQuiz starting...", chat_id, call.message.message_id)
 
-    session = user_sessions.get(chat_id)
-    session["start_time"] = datetime.now()
+    session["start_time"] = session["last_used"] = datetime.now()
 
-    bot.send_message(chat_id, "🤖 Finding answers using Gemini AI...")
+    QUIZ_WORKERS.submit(start_quiz, chat_id, session, minutes)
 
-    for i, q in enumerate(session["mcqs"]):
-        ca = gemini_answer(q["question"], q["options"])
+
+def start_quiz(chat_id, session, minutes):
+    try:
+        run_quiz(chat_id, session, minutes)
+    except Exception:
+        logging.exception("Failed to start quiz for chat %s", chat_id)
+        bot.send_message(chat_id, "❌ Could not start the quiz.")
+
+
+def run_quiz(chat_id, session, minutes):
+    if GEMINI_API_KEY:
+        send_with_retry(chat_id, "🤖 Finding answers using Gemini AI...")
+    else:
+        send_with_retry(chat_id, "⚠️ Gemini is not configured (GEMINI_API_KEY missing), so answers cannot be checked.")
+
+    for i, ca in enumerate(gemini_answer_batch(session["mcqs"])):
         session["correct_ans"][i] = ca
 
-    bot.send_message(chat_id, "🔥 All answers ready! Sending full quiz...")
+    send_with_retry(chat_id, "🔥 All answers ready! Sending full quiz...")
 
     for i, q in enumerate(session["mcqs"]):
-        text = f"**Q{i+1}.** {q['question']}\n\n"
-        text += f"A) {q['options']['A']}\n"
-        text += f"B) {q['options']['B']}\n"
-        text += f"C) {q['options']['C']}\n"
-        text += f"D) {q['options']['D']}\n"
+        text = Q_TEMPLATE.format(n=i + 1, q=q["question"], **q["options"])
+        send_with_retry(chat_id, text, parse_mode='Markdown', reply_markup=answer_markup(i))
+
+    schedule_result(chat_id, minutes)
+
+
+# ---------------------- QUESTION MESSAGE ----------------------
+Q_TEMPLATE = "**Q{n}.** {q}\n\nA) {A}\nB) {B}\nC) {C}\nD) {D}\n"
+OPTION_LETTERS = ("A", "B", "C", "D")
+
+
+@lru_cache(maxsize=1024)
+def answer_markup(i):
+    # Serialized once per question index; telebot passes JSON strings through unchanged.
+    return telebot.types.InlineKeyboardMarkup(keyboard=[
+        [telebot.types.InlineKeyboardButton(opt, callback_data=f"ans_{i}_{opt}")]
+        for opt in OPTION_LETTERS
+    ]).to_json()
 
-        markup = telebot.types.InlineKeyboardMarkup()
-        for opt in ["A", "B", "C", "D"]:
-            markup.add(telebot.types.InlineKeyboardButton(opt, callback_data=f"ans_{i}_{opt}"))
 
-        bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=markup)
+# ---------------------- FLOOD-SAFE SEND ----------------------
+# Quiz traffic (status, questions, results) goes through send_with_retry.
+SEND_RATE = 25   # messages/sec across all chats, under Telegram's ~30/sec bot limit
+SEND_LOCK = threading.Lock()
+next_send_at = 0.0
 
-    threading.Thread(target=quiz_timer, args=(chat_id, minutes)).start()
+
+def wait_send_slot():
+    # Hand out evenly spaced send slots so concurrent quizzes don't trip flood control.
+    global next_send_at
+    with SEND_LOCK:
+        now = time.monotonic()
+        slot = max(now, next_send_at)
+        next_send_at = slot + 1.0 / SEND_RATE
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def send_with_retry(chat_id, text, **kwargs):
+    # On HTTP 429, wait for Telegram's retry_after and resend instead of dropping the message.
+    while True:
+        wait_send_slot()
+        try:
+            return bot.send_message(chat_id, text, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 429:
+                raise
+            time.sleep(e.result_json.get("parameters", {}).get("retry_after", 1))
 
 
 # ---------------------- USER ANSWERS ----------------------
@@ -186,16 +447,46 @@ def handle_answer(call):
     _, qnum, opt = call.data.split("_")
     qnum = int(qnum)
 
-    user_sessions[chat_id]["answers"][qnum] = opt
+    session = user_sessions.get(chat_id)
+    if not session:
+        bot.answer_callback_query(call.id, "❌ No active quiz.")
+        return
+
+    session["answers"][qnum] = opt
+    session["last_used"] = datetime.now()
 
     bot.answer_callback_query(call.id, f"Selected {opt}")
 
 
 # ---------------------- TIMER END ----------------------
-def quiz_timer(chat_id, minutes):
-    import time
-    time.sleep(minutes * 60)
-    show_result(chat_id)
+# One scheduler thread serves every running quiz instead of a sleeping thread each.
+SCHED_HEAP = []   # (deadline, chat_id), earliest deadline first
+SCHED_CV = threading.Condition()
+
+
+def schedule_result(chat_id, minutes):
+    with SCHED_CV:
+        heapq.heappush(SCHED_HEAP, (time.monotonic() + minutes * 60, chat_id))
+        SCHED_CV.notify()
+
+
+def quiz_scheduler():
+    while True:
+        with SCHED_CV:
+            while not SCHED_HEAP or SCHED_HEAP[0][0] > time.monotonic():
+                timeout = SCHED_HEAP[0][0] - time.monotonic() if SCHED_HEAP else None
+                SCHED_CV.wait(timeout)
+            _, chat_id = heapq.heappop(SCHED_HEAP)
+
+        # the scheduler only pops deadlines; a slow or retrying send must not delay other quizzes
+        QUIZ_WORKERS.submit(post_result, chat_id)
+
+
+def post_result(chat_id):
+    try:
+        show_result(chat_id)
+    except Exception:
+        logging.exception("Failed to post result for chat %s", chat_id)
 
 
 # ---------------------- RESULT FUNCTION ----------------------
@@ -232,7 +523,7 @@ Total Questions: {total}
 Accuracy: {round((correct/total)*100)}%
 """
 
-    bot.send_message(chat_id, result_msg, parse_mode='Markdown')
+    send_with_retry(chat_id, result_msg, parse_mode='Markdown')
 
 
 # ---------------------- /solve COMMAND ----------------------
@@ -252,7 +543,17 @@ def solve_q(message):
         bot.reply_to(message, "❌ No active quiz.")
         return
 
+    if not GEMINI_API_KEY:
+        bot.reply_to(message, "❌ AI explanations are not configured.")
+        return
+
     q = session["mcqs"][num]
+    key = mcq_key(q["question"], q["options"])
+    cached = EXPLAIN_CACHE.get(key)
+    if cached is not None:
+        bot.send_message(chat_id, cached)
+        return
+
     prompt = f"""
 Explain this MCQ in detail with correct answer.
 
@@ -266,11 +567,14 @@ C) {q['options']['C']}
 D) {q['options']['D']}
 """
 
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key=" + GEMINI_API_KEY
     data = {"contents": [{"parts": [{"text": prompt}]}]}
-    r = requests.post(url, json=data)
-
-    explanation = r.json()["candidates"][0]["content"]["parts"][0]["text"]
+    try:
+        r = gemini_post(GEMINI_TEXT_URL, data)
+        explanation = orjson.loads(r.content)["candidates"][0]["content"]["parts"][0]["text"]
+    except (requests.RequestException, KeyError, IndexError, ValueError):
+        bot.reply_to(message, "❌ Could not get an explanation right now. Try again later.")
+        return
+    cache_put(EXPLAIN_CACHE, key, explanation)
 
     bot.send_message(chat_id, explanation)
 
@@ -288,6 +592,10 @@ def home():
     return "Bot Running Successfully!"
 
 
+# ---------------------- START SCHEDULER ----------------------
+threading.Thread(target=quiz_scheduler, daemon=True).start()
+
+
 # ---------------------- SET WEBHOOK ----------------------
 bot.remove_webhook()
 bot.set_webhook(url=WEBHOOK_URL)
@@ -1,2 +1,3 @@
 #!/usr/bin/env bash
-python3 bot.py
+# One worker: quiz sessions and the result scheduler live in process memory.
+exec gunicorn --workers 1 --worker-class gthread --threads 8 --bind "0.0.0.0:${PORT:-10000}" bot:app